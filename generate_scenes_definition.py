@@ -13,6 +13,7 @@ from itertools import groupby
 from collections import defaultdict
 
 import json
+import orjson
 import numpy as np
 
 from utils.misc import init_random_seed, generate_info_section, save_arguments
@@ -89,14 +90,24 @@ class Scene_generator:
                  constraint_min_nb_families,
                  constraint_min_objects_per_family,
                  constraint_min_nb_families_subject_to_min_object_per_family,
-                 constraint_min_ratio_for_attribute):
+                 constraint_min_ratio_for_attribute,
+                 random_seed=None,
+                 analysis_cache_filepath=None):
 
         self.version_nb = version_nb
 
+        # Random generator used to sample the scenes
+        self.rng = np.random.default_rng(random_seed)
+
         with open(metadata_filepath) as metadata:
             self.attributes_values = {key: val['values'] for key, val in json.load(metadata)['attributes'].items()}
 
-        self.elementary_sounds = Elementary_Sounds(elementary_sounds_folderpath, elementary_sounds_definition_filename)
+        self.elementary_sounds = Elementary_Sounds(elementary_sounds_folderpath,
+                                                   elementary_sounds_definition_filename,
+                                                   analysis_cache_filepath=analysis_cache_filepath)
+
+        # Plain list copy of the family indexes, scalar access on a list is faster than on a numpy array
+        self.family_index_by_id = self.elementary_sounds.family_index_by_id.tolist()
 
         self.nb_objects_per_scene = {
             'min': min_nb_objects_per_scene,
@@ -130,6 +141,30 @@ class Scene_generator:
         # Attributes on which the 'min_ratio_for_attribute' constraint will be applied
         self.constrained_attributes = ['brightness', 'loudness']
 
+        # Smallest scene that can satisfy the families constraints :
+        #   'min_nb_families_subject_to_min_objects_per_family' families with 'min_objects_per_family' objects
+        #   + 1 object for each of the other families required by 'min_nb_families'
+        nb_families_subject_to_min_objects = self.constraints['min_nb_families_subject_to_min_objects_per_family']
+        min_feasible_nb_objects = self.constraints['min_objects_per_family'] * nb_families_subject_to_min_objects
+        min_feasible_nb_objects += max(0, self.constraints['min_nb_families'] - nb_families_subject_to_min_objects)
+
+        if min_feasible_nb_objects > self.nb_objects_per_scene['max']:
+            print("[ERROR] The constraints can't be satisfied by scenes of %d objects or less. At least %d are needed."
+                  % (self.nb_objects_per_scene['max'], min_feasible_nb_objects), file=sys.stderr)
+            exit(1)
+
+        # Scene lengths that would always fail the constraints are never drawn
+        self.nb_objects_to_draw = {
+            'min': max(self.nb_objects_per_scene['min'], min_feasible_nb_objects),
+            'max': self.nb_objects_per_scene['max']
+        }
+
+        # Lower bound of the swap index for each position of the partial Fisher-Yates shuffle
+        self.swap_low_bounds = np.arange(self.nb_objects_to_draw['max'])
+
+        # Relationships of the scenes (Computed by _generate_relationships)
+        self.relationships_by_nb_object = {}
+
         # Stats
         self.stats = {
             'levels': {},
@@ -143,15 +178,21 @@ class Scene_generator:
         return [self.elementary_sounds.get(idx) for idx in scene_id_list]
 
     def _generate_scene_id_list(self):
-        # Shuffle all sounds and pick the first 'nb_objects_per_scene' as the scene
-        np.random.shuffle(self.elementary_sounds.id_list_shuffled)
+        nb_sound = self.rng.integers(self.nb_objects_to_draw['min'], self.nb_objects_to_draw['max'] + 1)
+
+        # Partial Fisher-Yates shuffle : Only the first 'nb_sound' positions are shuffled and picked as the scene
+        id_list = self.elementary_sounds.id_list_shuffled
+        swap_indexes = self.rng.integers(self.swap_low_bounds[:nb_sound], len(id_list))
+        for i, j in enumerate(swap_indexes):
+            id_list[i], id_list[j] = id_list[j], id_list[i]
 
-        nb_sound = np.random.randint(self.nb_objects_per_scene['min'], self.nb_objects_per_scene['max'] + 1)
+        return id_list[:nb_sound]
 
-        return self.elementary_sounds.id_list_shuffled[:nb_sound]
+    def _validate_scene(self, scene_id_list):
+        nb_object_in_scene = len(scene_id_list)
 
-    def _validate_scene(self, scene_objects):
-        nb_object_in_scene = len(scene_objects)
+        # The definitions are only read during the validation, no need to copy them
+        scene_objects = [self.elementary_sounds.definition[idx] for idx in scene_id_list]
 
         # Validate duration constraint
         total_sound_duration = sum([s['duration'] for s in scene_objects])
@@ -159,16 +200,23 @@ class Scene_generator:
         if self.scene_duration['min'] <= total_sound_duration >= self.scene_duration['max']:
             return False
 
-        # Validate min_nb_families constraint
-        families_count, current_nb_families = self.elementary_sounds.sounds_to_families_count(scene_objects)
+        # Count the objects per family
+        # The scenes are small, counting in a list indexed by family is faster than np.bincount
+        families_count = [0] * self.elementary_sounds.nb_families
+        for idx in scene_id_list:
+            families_count[self.family_index_by_id[idx]] += 1
+
+        current_nb_families = sum(1 for count in families_count if count > 0)
 
+        # Families that are absent from the scene are also valid when the minimum is 0
+        valid_families_count = sum(1 for count in families_count
+                                   if count >= self.constraints['min_objects_per_family'])
+
+        # Validate min_nb_families constraint
         if current_nb_families < self.constraints['min_nb_families']:
             return False
 
         # Validate that we have the minimum objects per families
-        valid_families_count = sum([1 for family, count in families_count.items()
-                                    if count >= self.constraints['min_objects_per_family']])
-
         if valid_families_count < self.constraints['min_nb_families_subject_to_min_objects_per_family']:
             return False
 
@@ -195,23 +243,21 @@ class Scene_generator:
         return True
 
     def _generate_scenes(self, nb_to_generate):
-        processed_ids = defaultdict(lambda: False)
-        valid_ids = defaultdict(lambda: False)
+        # Scenes (Ordered ids) that were already drawn. Each scene is only validated once
+        processed_ids = set()
         scenes = []
         counter = 0
 
         while counter < nb_to_generate:
             scene_id_list = self._generate_scene_id_list()
-            hashmap_index = str(scene_id_list)
-            scene_objects = self._scene_id_list_to_sound_list(scene_id_list)
+            scene_key = tuple(scene_id_list)
 
-            if not processed_ids[hashmap_index]:
-                processed_ids[hashmap_index] = True
-                if not valid_ids[hashmap_index]:
-                    if self._validate_scene(scene_objects):
-                        valid_ids[hashmap_index] = True
-                        scenes.append(scene_objects)
-                        counter += 1
+            if scene_key not in processed_ids:
+                processed_ids.add(scene_key)
+                if self._validate_scene(scene_id_list):
+                    # Only the ids are kept. The sounds definition are copied when the scene is written
+                    scenes.append(scene_key)
+                    counter += 1
 
         return scenes
 
@@ -255,6 +301,11 @@ class Scene_generator:
 
     def _generate_relationships(self, scene_composition):
         # TODO : Those relationships are trivial. Could be moved to question engine (Before & after)
+        # They only depend on the number of objects, they are computed once for each scene length
+        nb_object = len(scene_composition)
+        if nb_object in self.relationships_by_nb_object:
+            return self.relationships_by_nb_object[nb_object]
+
         relationships = [
             {
                 'type': 'before',
@@ -268,8 +319,7 @@ class Scene_generator:
             }
         ]
 
-        nb_object = len(scene_composition)
-        scene_indexes = list(range(0, nb_object))   # NOTE : Would not work with variable scene length
+        scene_indexes = list(range(0, nb_object))
 
         for i in range(0, nb_object):
             if i - 1 >= 0:
@@ -278,6 +328,8 @@ class Scene_generator:
             scene_indexes.remove(i)
             relationships[1]['indexes'].append(list(scene_indexes))
 
+        self.relationships_by_nb_object[nb_object] = relationships
+
         return relationships
 
     def generate(self, nb_to_generate, training_set_ratio=0.7, shuffle_scenes=True):
@@ -289,67 +341,58 @@ class Scene_generator:
         print("Generated %d scenes" % len(generated_scenes))
 
         if shuffle_scenes:
-            np.random.shuffle(generated_scenes)
+            self.rng.shuffle(generated_scenes)
 
         # Separating train, valid and test sets
         nb_scene = len(generated_scenes)
         nb_training = round(nb_scene*training_set_ratio)
         valid_and_test_ratio = (1.0 - training_set_ratio) / 2
         nb_valid = round(nb_scene*valid_and_test_ratio)
-        nb_test = nb_scene - nb_training - nb_valid
 
-        training_scenes = []
-        valid_scenes = []
-        test_scenes = []
+        scenes_by_set = {
+            'train': generated_scenes[:nb_training],
+            'val': generated_scenes[nb_training:nb_training + nb_valid],
+            'test': generated_scenes[nb_training + nb_valid:]
+        }
 
-        training_index = 0
-        valid_index = 0
-        test_index = 0
+        # The scenes of each set are built lazily so they can be streamed to file one by one
+        # NOTE : The sets must be consumed in order (train, val, test) to get reproducible silence intervals
+        return {
+            set_type: {
+                "info": generate_info_section(set_type, self.version_nb),
+                "scenes": self._build_scenes(set_type, set_scenes)
+            } for set_type, set_scenes in scenes_by_set.items()
+        }
 
-        scene_count = 0
-        for generated_scene in generated_scenes:
+    def _build_scenes(self, set_type, set_scenes):
+        for scene_index, scene_id_list in enumerate(set_scenes):
+            generated_scene = self._scene_id_list_to_sound_list(scene_id_list)
             silence_before = self._assign_silence_informations(generated_scene)
 
-            scene = {
+            yield {
                 "silence_before": silence_before,
                 "objects": generated_scene,
-                "relationships": self._generate_relationships(generated_scene)
+                "relationships": self._generate_relationships(generated_scene),
+                "scene_index": f"{scene_index:06d}",
+                "scene_filename": f"CLEAR_{set_type}_{scene_index:06d}.flac"
             }
 
-            if scene_count < nb_training:
-                scene['scene_index'] = '%.6d' % training_index
-                scene['scene_filename'] = "CLEAR_train_%06d.flac" % training_index
-                training_index += 1
-                training_scenes.append(scene)
-
-            elif scene_count < nb_training + nb_valid:
-                scene['scene_index'] = '%.6d' % valid_index
-                scene['scene_filename'] = "CLEAR_val_%06d.flac" % valid_index
-                valid_index += 1
-                valid_scenes.append(scene)
 
-            else:
-                scene['scene_index'] = '%.6d' % test_index
-                scene['scene_filename'] = "CLEAR_test_%06d.flac" % test_index
-                test_index += 1
-                test_scenes.append(scene)
+def write_scenes_json(filepath, scene_struct):
+    """
+    Stream the scenes to the JSON file one at a time (One scene per line)
+    The whole JSON document is never built in memory
+    """
+    with open(filepath, 'wb') as f:
+        f.write(b'{\n  "info": %s,\n  "scenes": [' % orjson.dumps(scene_struct['info'], option=orjson.OPT_SORT_KEYS))
 
-            scene_count += 1
+        separator = b'\n    '
+        for scene in scene_struct['scenes']:
+            f.write(separator)
+            f.write(orjson.dumps(scene, option=orjson.OPT_SORT_KEYS))
+            separator = b',\n    '
 
-        return {
-            "train" : {
-                "info": generate_info_section('train', self.version_nb),
-                "scenes": training_scenes
-            },
-            "val": {
-                "info": generate_info_section('val', self.version_nb),
-                "scenes": valid_scenes
-            },
-            "test": {
-                "info": generate_info_section('test', self.version_nb),
-                "scenes": test_scenes
-            }
-        }
+        f.write(b'\n  ]\n}\n')
 
 
 if __name__ == '__main__':
@@ -391,7 +434,10 @@ if __name__ == '__main__':
                                       args.constraint_min_nb_families,
                                       args.constraint_min_object_per_family,
                                       args.constraint_min_nb_families_subject_to_min_object_per_family,
-                                      args.constraint_min_ratio_for_attribute)
+                                      args.constraint_min_ratio_for_attribute,
+                                      random_seed=args.random_nb_generator_seed,
+                                      analysis_cache_filepath=os.path.join(args.output_folder,
+                                                                           'elementary_sounds_analysis_cache.json'))
 
     scenes = scene_generator.generate(nb_to_generate=args.nb_scene, training_set_ratio=args.training_set_ratio)
 
@@ -401,7 +447,6 @@ if __name__ == '__main__':
 
         scenes_filepath = os.path.join(scenes_output_folder, scenes_filename)
 
-        with open(scenes_filepath, 'w') as f:
-            json.dump(scene_struct, f, indent=2, sort_keys=True)
+        write_scenes_json(scenes_filepath, scene_struct)
 
     print('done')
@@ -8,27 +8,27 @@
 #               IGLU - CHIST-ERA
 
 
-import sys, os, argparse, random
-from multiprocessing import Process, Queue
+import sys, os, argparse
+from multiprocessing import Pool
 from shutil import rmtree as rm_dir
 from datetime import datetime
-import time
-import gc
+from math import gcd
 
 import json
-from pydub import AudioSegment
-from pydub.utils import get_array_type
+import orjson
 import numpy as np
-import matplotlib
+import scipy.fft
+import scipy.signal
+import soundfile
+from matplotlib import cm
+from PIL import Image
 
-# Matplotlib options to reduce memory usage
-matplotlib.interactive(False)
-matplotlib.use('agg')
-import matplotlib.pyplot as plt
+from utils.audio_processing import add_reverberation, generate_random_noise, frame_and_window
+from utils.misc import init_random_seed
+from utils.misc import save_arguments, ndarray_to_shared_memory, ndarray_from_shared_memory
 
-from utils.audio_processing import add_reverberation, generate_random_noise
-from utils.misc import init_random_seed, pydub_audiosegment_to_float_array, float_array_to_pydub_audiosegment
-from utils.misc import save_arguments
+# Colormap lookup table used for the spectrograms (256 RGBA entries)
+spectrogram_colormap_lut = cm.viridis(np.arange(cm.viridis.N), bytes=True)
 
 """
 Arguments definition
@@ -96,8 +96,8 @@ parser.add_argument('--produce_specific_scenes', default="", type=str,
 # Misc
 parser.add_argument('--random_nb_generator_seed', default=None, type=int,
                     help='Set the random number generator seed to reproduce results')
-parser.add_argument('--nb_process', default=4, type=int,
-                    help='Number of process allocated for the production')
+parser.add_argument('--nb_process', default=max(1, (os.cpu_count() or 1) - 1), type=int,
+                    help='Number of process allocated for the production. Default to all cores but one')
 
 """
     Produce audio recording from scene JSON definition
@@ -140,6 +140,7 @@ class AudioSceneProducer:
 
         self.outputPrefix = outputPrefix
         self.setType = setType
+        self.sceneFilenamePrefix = '%s_%s_' % (self.outputPrefix, self.setType)
 
         self.produce_audio_files = produce_audio_files
         self.produce_spectrograms = produce_spectrograms
@@ -153,47 +154,36 @@ class AudioSceneProducer:
         # Loading scenes definition
         sceneFilename = '%s_%s_scenes.json' % (self.outputPrefix, self.setType)
         sceneFilepath = os.path.join(experiment_output_folder, 'scenes', sceneFilename)
-        with open(sceneFilepath) as scenesJson:
-            self.scenes = json.load(scenesJson)['scenes']
+        # orjson parses the (possibly very large) scenes file much faster than the json module
+        with open(sceneFilepath, 'rb') as scenesJson:
+            self.scenes = orjson.loads(scenesJson.read())['scenes']
 
         self.spectrogramSettings = spectrogramSettings
+        # The same Hann window (Same as matplotlib.mlab.window_hanning) is used for every spectrogram
+        self.spectrogramWindow = np.hanning(self.spectrogramSettings['window_length']).astype(np.float32)
+        self.spectrogramFrameBuffer = None
+        self.spectrogramRowIndexes = None
         self.withBackgroundNoise = withBackgroundNoise
         self.backgroundNoiseGainSetting = backgroundNoiseGainSetting
         self.withReverb = withReverb
         self.reverbSettings = reverbSettings
         self.outputFrameRate = outputFrameRate
 
-        root_images_output_folder = os.path.join(experiment_output_folder, 'images')
-        root_audio_output_folder = os.path.join(experiment_output_folder, 'audio')
-
-        if not os.path.isdir(experiment_output_folder):
-            # This is impossible, if the experiment folder doesn't exist we won't be able to retrieve the scenes
-            os.mkdir(experiment_output_folder)
-
-        self.images_output_folder = os.path.join(root_images_output_folder, self.setType)
-        self.audio_output_folder = os.path.join(root_audio_output_folder, self.setType)
+        self.images_output_folder = os.path.join(experiment_output_folder, 'images', self.setType)
+        self.audio_output_folder = os.path.join(experiment_output_folder, 'audio', self.setType)
 
+        output_folders = []
         if self.produce_audio_files:
-            if not os.path.isdir(root_audio_output_folder):
-                os.mkdir(root_audio_output_folder)
-                os.mkdir(self.audio_output_folder)
-            else:
-                if not os.path.isdir(self.audio_output_folder):
-                    os.mkdir(self.audio_output_folder)
-                elif clear_existing_files:
-                    rm_dir(self.audio_output_folder)
-                    os.mkdir(self.audio_output_folder)
+            output_folders.append(self.audio_output_folder)
 
         if self.produce_spectrograms:
-            if not os.path.isdir(root_images_output_folder):
-                os.mkdir(root_images_output_folder)
-                os.mkdir(self.images_output_folder)
-            else:
-                if not os.path.isdir(self.images_output_folder):
-                    os.mkdir(self.images_output_folder)
-                elif clear_existing_files:
-                    rm_dir(self.images_output_folder)
-                    os.mkdir(self.images_output_folder)
+            output_folders.append(self.images_output_folder)
+
+        for output_folder in output_folders:
+            if clear_existing_files and os.path.isdir(output_folder):
+                rm_dir(output_folder)
+
+            os.makedirs(output_folder, exist_ok=True)
 
         self.currentSceneIndex = -1  # We start at -1 since nextScene() will increment idx at the start of the fct
         self.nbOfLoadedScenes = len(self.scenes)
@@ -205,166 +195,279 @@ class AudioSceneProducer:
         self.show_status_every = int(self.nbOfLoadedScenes / 10)
         self.show_status_every = self.show_status_every if self.show_status_every > 0 else 1
 
-        self.loadedSounds = []
+        self.loadedSounds = {}
+        self.sharedMemoryBlocks = []
+        self.sharedSamplesDescriptors = {}
+        self.frameRate = None
+        self.backgroundNoise = None
         self.randomSeed = randomSeed
 
     def loadAllElementarySounds(self):
         print("Loading elementary sounds")
+        frameRates = {}
+        subtypes = set()
         for sound in self.elementarySounds:
-            # Creating the audio segment (Suppose WAV format)
             soundFilepath = os.path.join(self.elementarySoundFolderPath, sound['filename'])
-            soundAudioSegment = AudioSegment.from_wav(soundFilepath)
-
-            if self.outputFrameRate and soundAudioSegment.frame_rate != self.outputFrameRate:
-                soundAudioSegment = soundAudioSegment.set_frame_rate(self.outputFrameRate)
 
-            self.loadedSounds.append({
-                'name': sound['filename'],
-                'audioSegment': soundAudioSegment
-            })
-
-        print("Done loading elementary sounds")
-
-    def _getLoadedAudioSegmentByName(self, name):
-        filterResult = list(filter(lambda sound: sound['name'] == name, self.loadedSounds))
-        if len(filterResult) == 1:
-            return filterResult[0]['audioSegment']
+            # The samples are normalized in [-1, 1]. The elementary sounds are never modified
+            with soundfile.SoundFile(soundFilepath) as soundFile:
+                floatSamples = soundFile.read(dtype='float32')
+                frameRates[sound['filename']] = soundFile.samplerate
+                subtypes.add(soundFile.subtype)
+
+            # The scenes are produced in mono. Multichannel sounds are downmixed once here
+            if floatSamples.ndim > 1:
+                floatSamples = floatSamples.mean(axis=1, dtype=np.float32)
+
+            self.loadedSounds[sound['filename']] = {
+                'floatSamples': floatSamples,
+                'nbSamples': len(floatSamples)
+            }
+
+        # The scenes are assembled and written without resampling, every sound must have the same frame rate.
+        # Like pydub when overlaying segments, the sounds are brought to the highest frame rate
+        # unless an output frame rate is requested
+        if self.outputFrameRate:
+            self.frameRate = self.outputFrameRate
         else:
-            print('[ERROR] Could not retrieve loaded audio segment \'' + name + '\' from memory.')
-            exit(1)
+            self.frameRate = max(frameRates.values())
+
+        for filename, frameRate in frameRates.items():
+            if frameRate != self.frameRate:
+                loadedSound = self.loadedSounds[filename]
+                ratioGcd = gcd(self.frameRate, frameRate)
+                loadedSound['floatSamples'] = scipy.signal.resample_poly(loadedSound['floatSamples'],
+                                                                         self.frameRate // ratioGcd,
+                                                                         frameRate // ratioGcd).astype(np.float32)
+                loadedSound['nbSamples'] = len(loadedSound['floatSamples'])
+
+        # The scenes are written with the widest sample format of the elementary sounds
+        # FLAC support up to 24 bits per sample
+        self.audioSubtype = 'PCM_16' if subtypes == {'PCM_16'} else 'PCM_24'
+
+        # The height of the spectrograms only depends on the frame rate
+        # The frequency bins kept when resizing (Low frequencies at the bottom of the image) are computed once
+        spectrogramHeight = int(self.frameRate / 2 // self.spectrogramSettings['freqResolution'])
+        nbFrequencyBins = len(self.spectrogramWindow) // 2 + 1
+        rowIndexes = ((np.arange(spectrogramHeight) + 0.5) * nbFrequencyBins / spectrogramHeight).astype(int)
+        self.spectrogramRowIndexes = rowIndexes[::-1]
 
-    def produceSceneProcess(self, queue, emptyQueueTimeout=5):
-        # Wait 1 sec for the main thread to fillup the queue
-        time.sleep(1)
-
-        emptyQueueCount = 0
-        while emptyQueueCount < emptyQueueTimeout:
-            if not queue.empty():
-                # Reset empty queue count
-                emptyQueueCount = 0
-
-                # Retrieve Id and produce scene
-                idToProcess = queue.get()
-                self.produceScene(idToProcess)
-            else:
-                emptyQueueCount += 1
-                time.sleep(random.random())
-
-        return
+        print("Done loading elementary sounds")
 
+    def moveLoadedSoundsToSharedMemory(self):
+        # The samples are copied once in shared memory blocks.
+        # The worker processes attach to those blocks instead of getting their own copy of every elementary sound
+        for filename, loadedSound in self.loadedSounds.items():
+            self.sharedSamplesDescriptors[filename] = {}
+            for key in ['floatSamples']:
+                sharedMemory, loadedSound[key], descriptor = ndarray_to_shared_memory(loadedSound[key])
+                self.sharedMemoryBlocks.append(sharedMemory)
+                self.sharedSamplesDescriptors[filename][key] = descriptor
+
+    def releaseSharedMemory(self):
+        # The arrays must be released before closing the memory blocks
+        self.loadedSounds = {}
+
+        for sharedMemory in self.sharedMemoryBlocks:
+            sharedMemory.close()
+            sharedMemory.unlink()
+
+        self.sharedMemoryBlocks = []
+        self.sharedSamplesDescriptors = {}
+
+    def __getstate__(self):
+        # When the producer is sent to a worker process, only the descriptors of the shared samples are sent
+        state = self.__dict__.copy()
+        if self.sharedSamplesDescriptors:
+            del state['loadedSounds']
+            del state['sharedMemoryBlocks']
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+        if 'loadedSounds' not in state:
+            # Attach to the shared samples
+            self.loadedSounds = {}
+            self.sharedMemoryBlocks = []
+            for filename, descriptors in self.sharedSamplesDescriptors.items():
+                self.loadedSounds[filename] = {}
+                for key, descriptor in descriptors.items():
+                    sharedMemory, self.loadedSounds[filename][key] = ndarray_from_shared_memory(descriptor)
+                    self.sharedMemoryBlocks.append(sharedMemory)
+
+                self.loadedSounds[filename]['nbSamples'] = len(self.loadedSounds[filename]['floatSamples'])
 
     def produceScene(self, sceneId):
-        # Since this function is run by different process, we must set the same seed for every process
-        init_random_seed(self.randomSeed)
-
         if sceneId < self.nbOfLoadedScenes:
+            # The random generator is seeded with the scene id so the result doesn't depend on the process
+            rng = np.random.default_rng([self.randomSeed, sceneId])
 
             scene = self.scenes[sceneId]
             if sceneId % self.show_status_every == 0:
                 print('Producing scene ' + str(sceneId), flush=True)
 
-            sceneAudioSegment = self.assembleAudioScene(scene)
-
-            if self.outputFrameRate and sceneAudioSegment.frame_rate != self.outputFrameRate:
-                sceneAudioSegment = sceneAudioSegment.set_frame_rate(self.outputFrameRate)
+            sceneSamples = self.assembleAudioScene(scene, rng)
 
             if self.produce_audio_files:
-                audioFilename = '%s_%s_%06d.flac' % (self.outputPrefix, self.setType, sceneId)
-                sceneAudioSegment.export(os.path.join(self.audio_output_folder, audioFilename), format='flac')
+                # The FLAC file is encoded in process (No ffmpeg subprocess)
+                audioFilename = f'{self.sceneFilenamePrefix}{sceneId:06d}.flac'
+                soundfile.write(os.path.join(self.audio_output_folder, audioFilename),
+                                sceneSamples,
+                                self.frameRate,
+                                format='FLAC',
+                                subtype=self.audioSubtype)
 
             if self.produce_spectrograms:
-                spectrogram = AudioSceneProducer.createSpectrogram(sceneAudioSegment,
-                                                                   self.spectrogramSettings['freqResolution'],
-                                                                   self.spectrogramSettings['timeResolution'],
-                                                                   self.spectrogramSettings['window_length'],
-                                                                   self.spectrogramSettings['window_overlap'])
-
-                imageFilename = '%s_%s_%06d.png' % (self.outputPrefix, self.setType, sceneId)
-                spectrogram.savefig(os.path.join(self.images_output_folder, imageFilename), dpi=100)
+                spectrogram = self.createSpectrogram(sceneSamples)
 
-                AudioSceneProducer.clearSpectrogram(spectrogram)
+                imageFilename = f'{self.sceneFilenamePrefix}{sceneId:06d}.png'
+                # Fast zlib compression level. The images are slightly bigger but much faster to encode
+                Image.fromarray(spectrogram, 'RGBA').save(os.path.join(self.images_output_folder, imageFilename),
+                                                          format='PNG',
+                                                          compress_level=1)
 
         else:
             print("[ERROR] The scene specified by id '%d' couln't be found" % sceneId)
 
-    def assembleAudioScene(self, scene):
-        sceneAudioSegment = AudioSegment.empty()
+    def _msToNbSamples(self, duration):
+        return int(duration * self.frameRate / 1000)
 
-        sceneAudioSegment += AudioSegment.silent(duration=scene['silence_before'])
+    def _getSceneNbSamples(self, scene):
+        nbSamples = self._msToNbSamples(scene['silence_before'])
         for sound in scene['objects']:
-            newAudioSegment = self._getLoadedAudioSegmentByName(sound['filename'])
+            nbSamples += self.loadedSounds[sound['filename']]['nbSamples'] + self._msToNbSamples(sound['silence_after'])
 
-            sceneAudioSegment += newAudioSegment
+        return nbSamples
+
+    def assembleAudioScene(self, scene, rng):
+        # Compute the offset of every sound in the scene
+        cursor = self._msToNbSamples(scene['silence_before'])
+        soundsToInsert = []
+        for sound in scene['objects']:
+            loadedSound = self.loadedSounds.get(sound['filename'])
+            if loadedSound is None:
+                # Raised instead of exiting : The pool forwards the exception to the main process.
+                # A worker that exits would never return its results and the main process would wait forever
+                raise KeyError('Could not retrieve loaded audio segment \'' + sound['filename'] + '\' from memory.')
 
-            # Insert a silence padding after the sound
-            sceneAudioSegment += AudioSegment.silent(duration=sound['silence_after'])
+            soundsToInsert.append((cursor, loadedSound))
+
+            # Leave a silence padding after the sound
+            cursor += loadedSound['nbSamples'] + self._msToNbSamples(sound['silence_after'])
+
+        # The buffer is allocated once, the silences are left to zero
+        sceneSamples = np.zeros(cursor, dtype=np.float32)
+        for offset, loadedSound in soundsToInsert:
+            sceneSamples[offset:offset + loadedSound['nbSamples']] = loadedSound['floatSamples']
 
         if self.withBackgroundNoise:
-            gain = random.randrange(self.backgroundNoiseGainSetting['min'], self.backgroundNoiseGainSetting['max'])
-            sceneAudioSegment = AudioSceneProducer.overlayBackgroundNoise(sceneAudioSegment, gain)
+            gain = rng.integers(self.backgroundNoiseGainSetting['min'], self.backgroundNoiseGainSetting['max'])
+            self.overlayBackgroundNoise(sceneSamples, gain, rng)
 
         if self.withReverb:
-            roomScale = random.randrange(self.reverbSettings['roomScale']['min'],
-                                         self.reverbSettings['roomScale']['max'])
-            delay = random.randrange(self.reverbSettings['delay']['min'], self.reverbSettings['delay']['max'])
-            sceneAudioSegment = AudioSceneProducer.applyReverberation(sceneAudioSegment, roomScale, delay)
+            roomScale = rng.integers(self.reverbSettings['roomScale']['min'], self.reverbSettings['roomScale']['max'])
+            delay = rng.integers(self.reverbSettings['delay']['min'], self.reverbSettings['delay']['max'])
+            sceneSamples = AudioSceneProducer.applyReverberation(sceneSamples, roomScale, delay)
 
-        # Make sure the everything is in Mono (If stereo, will convert to mono)
-        sceneAudioSegment.set_channels(1)
+        # Saturate like the previous pydub mixing did. Out of range values would wrap around when written as PCM
+        np.clip(sceneSamples, -1.0, 1.0, out=sceneSamples)
 
-        return sceneAudioSegment
+        return sceneSamples
 
     @staticmethod
-    def applyReverberation(audioSegment, roomScale, delay):
-        floatArray = pydub_audiosegment_to_float_array(audioSegment, audioSegment.frame_rate, audioSegment.sample_width)
+    def applyReverberation(sceneSamples, roomScale, delay):
+        return add_reverberation(sceneSamples, room_scale=roomScale, pre_delay=delay)
+
+    def overlayBackgroundNoise(self, sceneSamples, noiseGain, rng):
+        # The noise is generated once per process (Twice the length of the longest scene)
+        # A random window of this noise is used for each scene
+        # It is generated from the same seed in every process
+        if self.backgroundNoise is None:
+            longestSceneNbSamples = max(self._getSceneNbSamples(scene) for scene in self.scenes)
+            self.backgroundNoise = generate_random_noise(2 * longestSceneNbSamples, 0,
+                                                         np.random.default_rng(self.randomSeed))
+
+        offset = rng.integers(0, len(self.backgroundNoise) - sceneSamples.size + 1)
+
+        # The noise is added in place, the scene buffer is not copied
+        sceneSamples += self.backgroundNoise[offset:offset + sceneSamples.size] * np.float32(10 ** (noiseGain / 20))
+
+    def createSpectrogram(self, sceneSamples):
+        width = int(len(sceneSamples) * 1000 / self.frameRate // self.spectrogramSettings['timeResolution'])
+
+        # Short time fourier transform
+        # Same framing as matplotlib specgram (No padding and no extension at the boundaries)
+        windowLength = len(self.spectrogramWindow)
+        hop = windowLength - self.spectrogramSettings['window_overlap']
+        nbFrames = (len(sceneSamples) - windowLength) // hop + 1
+
+        # The frame buffer is reused between scenes and only grows when a longer scene is produced
+        if self.spectrogramFrameBuffer is None or len(self.spectrogramFrameBuffer) < nbFrames:
+            self.spectrogramFrameBuffer = np.empty((nbFrames, windowLength), dtype=np.float32)
+
+        frames = frame_and_window(sceneSamples, self.spectrogramWindow, hop, out=self.spectrogramFrameBuffer[:nbFrames])
+
+        # scipy.fft keeps a cache of the FFT plans, the same window length is used for every scene
+        # The production is already distributed across processes so we only use 1 worker for the FFT
+        stft = scipy.fft.rfft(frames, axis=-1, workers=1)
+
+        # Resize to the image size (Nearest neighbour)
+        # Frequencies are on the second axis of the stft, time on the first axis
+        colIndexes = ((np.arange(width) + 0.5) * stft.shape[0] / width).astype(int)
+        magnitude = np.abs(stft[colIndexes][:, self.spectrogramRowIndexes].T)
+
+        # Digital silence has no dB value (-inf). Like matplotlib, those pixels are transparent
+        # and are not used to normalize the other pixels
+        silentPixels = magnitude == 0
+        hasSilentPixels = silentPixels.any()
+
+        # The dB conversion is only done on the pixels that are kept in the image
+        # Every step is done in place so no temporary array is allocated
+        spectrogram = magnitude
+        np.log10(spectrogram, out=spectrogram, where=~silentPixels)
+        spectrogram *= 20
+
+        # Normalize in [0, 1] over the non silent pixels and apply the colormap
+        # (Same quantization as matplotlib colormaps)
+        soundPixels = spectrogram[~silentPixels] if hasSilentPixels else spectrogram
+        if soundPixels.size > 0:
+            minValue = soundPixels.min()
+            maxValue = soundPixels.max()
+        else:
+            minValue = maxValue = 0
 
-        floatArrayWithReverb = add_reverberation(floatArray, room_scale=roomScale, pre_delay=delay)
+        spectrogram -= minValue
+        if maxValue > minValue:
+            spectrogram /= maxValue - minValue
+        else:
+            spectrogram[...] = 0
 
-        return float_array_to_pydub_audiosegment(floatArrayWithReverb, audioSegment.frame_rate,
-                                                 audioSegment.sample_width)
+        colorIndexes = np.clip((spectrogram * len(spectrogram_colormap_lut)).astype(np.intp),
+                               0, len(spectrogram_colormap_lut) - 1)
 
-    @staticmethod
-    def overlayBackgroundNoise(sceneAudioSegment, noiseGain):
-        backgroundNoise = generate_random_noise(sceneAudioSegment.duration_seconds * 1000,
-                                                noiseGain,
-                                                sceneAudioSegment.frame_width,
-                                                sceneAudioSegment.frame_rate)
+        image = spectrogram_colormap_lut[colorIndexes]
 
-        sceneAudioSegment = backgroundNoise.overlay(sceneAudioSegment)
+        if hasSilentPixels:
+            # Colormap 'bad' color (Fully transparent)
+            image[silentPixels] = 0
 
-        return sceneAudioSegment
+        return image
 
-    @staticmethod
-    def createSpectrogram(sceneAudioSegment, freqResolution, timeResolution, windowLength, windowOverlap):
-        highestFreq = sceneAudioSegment.frame_rate/2
-        height = highestFreq // freqResolution
-        width = sceneAudioSegment.duration_seconds * 1000 // timeResolution
-
-        # Set figure settings to remove all axis
-        spectrogram = plt.figure(frameon=False)
-        spectrogram.set_size_inches(width/100, height/100)
-        ax = plt.Axes(spectrogram, [0., 0., 1., 1.])
-        ax.set_axis_off()
-        spectrogram.add_axes(ax)
-
-        # Generate the spectrogram
-        # See https://matplotlib.org/api/_as_gen/matplotlib.pyplot.specgram.html?highlight=matplotlib%20pyplot%20specgram#matplotlib.pyplot.specgram
-        Pxx, freqs, bins, im = ax.specgram(x=np.frombuffer(sceneAudioSegment._data,
-                                                            dtype=get_array_type(8*sceneAudioSegment.frame_width)),
-                                            Fs=sceneAudioSegment.frame_rate,
-                                            window=matplotlib.mlab.window_hanning,
-                                            NFFT=windowLength,
-                                            noverlap=windowOverlap,
-                                            scale='dB')
-
-        return spectrogram
 
-    @staticmethod
-    def clearSpectrogram(spectrogram):
-        # Close and Clear the figure
-        plt.close(spectrogram)
-        spectrogram.clear()
-        gc.collect()
+# Producer of the current worker process.
+# It is sent once to each worker by initWorker() instead of being pickled with every batch of scene ids
+workerProducer = None
+
+
+def initWorker(producer):
+    global workerProducer
+    workerProducer = producer
+
+
+def produceSceneInWorker(sceneId):
+    workerProducer.produceScene(sceneId)
 
 
 def mainPool():
@@ -443,37 +546,23 @@ def mainPool():
         idList = range(bounds[0], bounds[1])
         nb_generated = bounds[1] - bounds[0]
 
-    idList = iter(idList)
-
     # Load and preprocess all elementary sounds into memory
     producer.loadAllElementarySounds()
+    producer.moveLoadedSoundsToSharedMemory()
 
     startTime = datetime.now()
 
-    id_queue = Queue(maxsize=1000)
-    worker_processes = [Process(target=producer.produceSceneProcess, args=(id_queue,)) for i in range(args.nb_process)]
-
-    for p in worker_processes:
-        p.start()
-
-    done = False
-    while not done:
-        if not id_queue.full():
-            try:
-                id_queue.put(next(idList))
-            except StopIteration:
-                # Reached the end of the iterator
-                done = True
-        else:
-            # Producing the scenes take quite some time.
-            # We wait for 30 seconds in order to reduce context switch between main process and worker processes
-            time.sleep(30)
-
-    print("Done filling worker processes queue")
-
-    # Wait for all processes to finish
-    for p in worker_processes:
-        p.join()
+    # The ids are sent to the workers by batch to reduce the inter process communication overhead
+    # Each worker will receive ~4 batches so the load stays balanced
+    chunksize = max(1, nb_generated // (args.nb_process * 4))
+
+    try:
+        with Pool(processes=args.nb_process, initializer=initWorker, initargs=(producer,)) as pool:
+            # The scenes are consumed as soon as they are produced, no matter the order
+            for _ in pool.imap_unordered(produceSceneInWorker, idList, chunksize=chunksize):
+                pass
+    finally:
+        producer.releaseSharedMemory()
 
     print("Job Done !")
     print(f"Took {str(datetime.now() - startTime)}")
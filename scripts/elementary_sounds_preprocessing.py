@@ -1,30 +1,28 @@
 import os
 import sys
-import json
-from operator import attrgetter
+import orjson
 from shutil import copy2 as copyfile
 from shutil import rmtree as rmdir
 
-from pydub import AudioSegment
-from pydub.silence import split_on_silence
-
-from utils.audio_processing import get_perceptual_loudness
+from utils.audio_processing import get_perceptual_loudness, get_longest_non_silent_segment, load_wav_audiosegment
+from utils.audio_processing import apply_gain
+from utils.misc import map_concurrently
 
 
 def load_elementary_sounds_definition(elementary_sounds_folder_path, elementary_sounds_definition_filename):
   print("Loading elementary sounds definition")
   elementary_sounds_definition_filepath = os.path.join(elementary_sounds_folder_path, elementary_sounds_definition_filename)
-  with open(elementary_sounds_definition_filepath, 'r') as f:
-    definition = json.load(f)
+  with open(elementary_sounds_definition_filepath, 'rb') as f:
+    definition = orjson.loads(f.read())
   return definition
 
 
 def load_sounds(elementary_sounds_def, elementary_sounds_folder_path):
   print("Loading elementary sounds audio")
   audio_segments = []
-  for sound in elementary_sounds_def:
-    audio_segment = AudioSegment.from_wav(os.path.join(elementary_sounds_folder_path, sound['filename']))
+  filepaths = [os.path.join(elementary_sounds_folder_path, sound['filename']) for sound in elementary_sounds_def]
 
+  for sound, audio_segment in zip(elementary_sounds_def, map_concurrently(load_wav_audiosegment, filepaths)):
     audio_segments.append({
       'filename': sound['filename'],
       'audio_segment': audio_segment
@@ -38,15 +36,13 @@ def remove_silence(audio_segments, silence_thresh, min_silence_duration, begin_e
   new_audio_segments = []
 
   for sound in audio_segments:
-    non_silent_audio_chunks = split_on_silence(sound['audio_segment'], min_silence_duration, silence_thresh, begin_end_keep_silence_duration)
-
-    # Sort the non silent part by duration
-    non_silent_audio_chunks = sorted(non_silent_audio_chunks, key=attrgetter('duration_seconds'), reverse=True)
-
     # Use the longest non-silent part
     new_audio_segments.append({
       'filename': sound['filename'],
-      'audio_segment': non_silent_audio_chunks[0]
+      'audio_segment': get_longest_non_silent_segment(sound['audio_segment'],
+                                                      min_silence_duration,
+                                                      silence_thresh,
+                                                      begin_end_keep_silence_duration)
     })
 
   return new_audio_segments
@@ -59,7 +55,7 @@ def amplify_if_perceptual_loudness_in_range(audio_segments, amplification_factor
   for sound in audio_segments:
     perceptual_loudness = get_perceptual_loudness(sound['audio_segment'])
     if high_bound > perceptual_loudness > low_bound:
-      audio_segment = sound['audio_segment'].apply_gain(amplification_factor)
+      audio_segment = apply_gain(sound['audio_segment'], amplification_factor)
       print("Amplified '%s'" % sound['filename'])
     else:
       audio_segment = sound['audio_segment']
@@ -72,6 +68,10 @@ def amplify_if_perceptual_loudness_in_range(audio_segments, amplification_factor
   return new_audio_segments
 
 
+def export_audio_segment(audio_segment, filepath):
+  audio_segment.export(filepath, format='wav').close()
+
+
 def write_audio_segments(audio_segments, output_folder_path, original_folder_path, elementary_sounds_definition_filename):
   print("Writing new elementary sounds audio")
   if os.path.isdir(output_folder_path):
@@ -81,9 +81,8 @@ def write_audio_segments(audio_segments, output_folder_path, original_folder_pat
   os.mkdir(output_folder_path)
 
   # Writing all the audio segments
-  for sound in audio_segments:
-    filepath = os.path.join(output_folder_path, sound['filename'])
-    sound['audio_segment'].export(filepath, format='wav')
+  filepaths = [os.path.join(output_folder_path, sound['filename']) for sound in audio_segments]
+  map_concurrently(export_audio_segment, [sound['audio_segment'] for sound in audio_segments], filepaths)
 
   # Copy the definition file to the output folder
   old_definition_filepath = os.path.join(original_folder_path, elementary_sounds_definition_filename)
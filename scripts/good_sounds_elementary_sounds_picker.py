@@ -1,15 +1,15 @@
 import sqlite3
-import json
+import orjson
 import os
-from operator import attrgetter
 from shutil import rmtree as rmdir
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import argparse
 
-from pydub import AudioSegment
-from pydub.silence import split_on_silence
-
-from utils.audio_processing import get_perceptual_loudness
-from utils.misc import init_random_seed
+from utils.audio_processing import get_perceptual_loudness, load_wav_audiosegment
+from utils.audio_processing import linear_fade, linear_crossfade, apply_gain
+from utils.audio_processing import get_longest_non_silent_samples, reduce_samples_duration, apply_samples_gain
+from utils.misc import init_random_seed, map_concurrently
 
 '''
 Arguments definition
@@ -53,6 +53,8 @@ def connect_db(database_path):
     SQL Database connection
     """
     connection = sqlite3.connect(database_path)
+    # The columns of the results are accessed by name
+    connection.row_factory = sqlite3.Row
     return connection.cursor()
 
 
@@ -88,12 +90,12 @@ def db_rows_to_dict(results):
 
     for row in results:
         sounds.append({
-            'instrument': row[0],
-            'note': row[1],
-            'octave': row[2],
-            'filename': row[3],
-            'is_ref': row[4] == 1,
-            'pack': row[5]
+            'instrument': row['instrument'],
+            'note': row['note'],
+            'octave': row['octave'],
+            'filename': row['filename'],
+            'is_ref': row['reference'] == 1,
+            'pack': row['name']
         })
 
     return sounds
@@ -104,13 +106,25 @@ def load_sounds_in_memory(sounds, good_sounds_folder):
     Load audio segments into memory
     """
     print("Loading audio files in memory...")
-    for sound in sounds:
-        audio_segment = AudioSegment.from_wav(os.path.join(good_sounds_folder, sound['filename']))
+    filepaths = [os.path.join(good_sounds_folder, sound['filename']) for sound in sounds]
+
+    for sound, audio_segment in zip(sounds, map_concurrently(load_wav_audiosegment, filepaths)):
         sound['audio_segment'] = audio_segment
 
     return sounds
 
 
+def export_sound(sound, output_path):
+    """
+    Write the audio segment of a sound to a wav file named after its instrument, octave and note
+    """
+    new_filename = '%s_%s_%s.wav' % (sound['instrument'], sound['octave'], sound['note'])
+    sound['audio_segment'].export(os.path.join(output_path, new_filename), format='wav').close()
+    sound['filename'] = new_filename
+    del sound['audio_segment']
+    sound.pop('duration_ms', None)
+
+
 def write_sounds_to_files(sounds, output_path, definition_filename):
     """
     Write the audio segments to file and export the definition JSON file
@@ -122,56 +136,14 @@ def write_sounds_to_files(sounds, output_path, definition_filename):
 
     os.mkdir(output_path)
 
-    for sound in sounds:
-        new_filename = '%s_%s_%s.wav' % (sound['instrument'], sound['octave'], sound['note'])
-        sound['audio_segment'].export(os.path.join(output_path, new_filename), format='wav')
-        sound['filename'] = new_filename
-        del sound['audio_segment']
+    map_concurrently(partial(export_sound, output_path=output_path), sounds)
 
-    with open(os.path.join(output_path, definition_filename), 'w') as f:
-        json.dump(sounds, f, indent=2)
+    with open(os.path.join(output_path, definition_filename), 'wb') as f:
+        f.write(orjson.dumps(sounds, option=orjson.OPT_INDENT_2))
 
     print("Elementary sounds successfully written in '%s'" % output_path)
 
 
-def remove_silence(sounds, silence_thresh, min_silence_duration):
-    """
-    Remove the silence parts of the recordings
-    The recordings that we are filtering are sustained note instrumental recordings
-    therefore we keep only the longest non silent interval
-    """
-    print("Trimming silences...")
-    for sound in sounds:
-        non_silent_audio_chunks = split_on_silence(sound['audio_segment'],
-                                                   min_silence_duration,
-                                                   silence_thresh,
-                                                   100)
-
-        # Sort the non silent part by duration
-        non_silent_audio_chunks = sorted(non_silent_audio_chunks, key=attrgetter('duration_seconds'), reverse=True)
-
-        # Use the longest non-silent part
-        # (This is suitable only for the recordings of Good-Sounds dataset since they are sustained instrumental notes)
-        sound['audio_segment'] = non_silent_audio_chunks[0]
-
-    return sounds
-
-
-def amplify_by_instrument(sounds, amplification_factors):
-    """
-    Amplify the signals with different gain based on the instrument
-    """
-    print("Amplifying sounds by instruments...")
-    print(json.dumps(amplification_factors, indent=2))
-    for sound in sounds:
-        if sound['instrument'] in amplification_factors:
-            amplification_factor = amplification_factors[sound['instrument']]
-            if amplification_factor:
-                sound['audio_segment'] = sound['audio_segment'].apply_gain(amplification_factor)
-
-    return sounds
-
-
 def amplify_if_perceptual_loudness_in_range(sounds, amplification_factor, low_bound, high_bound):
     """
     If the perceptual loudness of the sound is between low_bound and high_bound --> Amplify it by the amplification_factor
@@ -182,60 +154,29 @@ def amplify_if_perceptual_loudness_in_range(sounds, amplification_factor, low_bo
 
         if high_bound > perceptual_loudness > low_bound:
             print(f"Amplifying with factor {amplification_factor}")
-            sound['audio_segment'] = sound['audio_segment'].apply_gain(amplification_factor)
+            sound['audio_segment'] = apply_gain(sound['audio_segment'], amplification_factor)
 
     return sounds
 
 
-def reduce_duration_linear_by_instrument(sounds, keep_ratios, fadeout_ratio=0.2):
-    print("Reduce elementary sounds duration by instrument...")
-    print(json.dumps(keep_ratios, indent=2))
-
-    for sound in sounds:
-        duration = int(sound['audio_segment'].duration_seconds * 1000)
-
-        if sound['instrument'] not in keep_ratios:
-            continue
-
-        if keep_ratios[sound['instrument']] is None:
-            continue
-
-        new_duration = int(duration * keep_ratios[sound['instrument']])
-
-        sound['audio_segment'] = sound['audio_segment'][:new_duration].fade_out(int(new_duration * fadeout_ratio))
-
-    return sounds
-
-
-def reduce_duration_linear_violin(sounds, keep_ratio_by_max_duration, fadeout_ratio=0.2):
-    for sound in sounds:
-        if sound['instrument'] != 'violin':
-            continue
-
-        duration = int(sound['audio_segment'].duration_seconds * 1000)
-
-        ratio_to_use = None
-        for max_duration, keep_ratio in keep_ratio_by_max_duration.items():
-            if duration < max_duration:
-                ratio_to_use = keep_ratio
-                break
-
-        if ratio_to_use is None:
-            ratio_to_use = list(keep_ratio_by_max_duration.values())[-1]
-
-        if ratio_to_use:
-            new_duration = int(duration * ratio_to_use)
+def get_violin_keep_ratio(duration, keep_ratio_by_max_duration):
+    """
+    Return the keep ratio of the first max duration that is longer than the sound (The last ratio otherwise)
+    """
+    for max_duration, keep_ratio in keep_ratio_by_max_duration.items():
+        if duration < max_duration:
+            return keep_ratio
 
-            sound['audio_segment'] = sound['audio_segment'][:new_duration].fade_out(int(new_duration * fadeout_ratio))
+    return list(keep_ratio_by_max_duration.values())[-1]
 
-    return sounds
 
 def reduce_duration_linear(sounds, keep_ratio, fadeout_ratio=0.2):
     for sound in sounds:
-        duration = int(sound['audio_segment'].duration_seconds * 1000)
+        duration = sound['duration_ms']
         new_duration = int(duration * keep_ratio)
 
-        sound['audio_segment'] = sound['audio_segment'][:new_duration].fade_out(int(new_duration * fadeout_ratio))
+        sound['audio_segment'] = linear_fade(sound['audio_segment'][:new_duration], int(new_duration * fadeout_ratio))
+        sound['duration_ms'] = new_duration
 
     return sounds
 
@@ -243,25 +184,77 @@ def reduce_duration_linear(sounds, keep_ratio, fadeout_ratio=0.2):
 def reduce_duration_crossfade(sounds, keep_ratio, fadeout_ratio=0.2, crossfade_ratio=0.05):
     print("Reducing durations...")
     for sound in sounds:
-        duration = int(sound['audio_segment'].duration_seconds * 1000)
+        duration = sound['duration_ms']
         first_part_duration = int(duration * keep_ratio)
         fadeout_duration = int(duration * fadeout_ratio)
         crossfade_duration = int(crossfade_ratio * (first_part_duration + fadeout_duration))
 
         first_part = sound['audio_segment'][:first_part_duration]
-        first_part_crossfade = first_part[-crossfade_duration:].fade(to_gain=-120, start=0, end=float('inf'))
         second_part = sound['audio_segment'][-fadeout_duration:]
-        second_part_crossfade = second_part[:crossfade_duration].fade(from_gain=-120, start=0, end=float('inf'))
-
-        test = first_part[:-crossfade_duration] + (first_part_crossfade * second_part_crossfade) + second_part[
-                                                                                                   crossfade_duration:]
 
         # sound['audio_segment'] = first_part.append(sound['audio_segment'][-fadeout_duration:], crossfade=crossfade_duration)
-        sound['audio_segment'] = test
+        sound['audio_segment'] = linear_crossfade(first_part, second_part, crossfade_duration)
+        sound['duration_ms'] = int(sound['audio_segment'].duration_seconds * 1000)
 
     return sounds
 
 
+def preprocess_sound(sound, silence_thresh, min_silence_duration, keep_ratios, violin_keep_ratio_by_max_duration,
+                     amplification_factors, fadeout_ratio=0.2):
+    """
+    Apply all the preprocessing steps on a single sound :
+    Trim the silences, reduce the duration by instrument (And by max duration for the violin) and amplify by instrument
+    Defined at module level so it can be run in worker processes
+    """
+    instrument = sound['instrument']
+    audio_segment = sound['audio_segment']
+    frame_rate = audio_segment.frame_rate
+
+    # All the steps work in place on a single copy of the samples, the audio segment is only rebuilt at the end
+    # Use the longest non-silent part
+    # (This is suitable only for the recordings of Good-Sounds dataset since they are sustained instrumental notes)
+    samples, duration = get_longest_non_silent_samples(audio_segment, min_silence_duration, silence_thresh, 100)
+
+    # Reduce the duration
+    keep_ratio = keep_ratios.get(instrument)
+    if keep_ratio is not None:
+        samples, duration = reduce_samples_duration(samples, frame_rate, duration, keep_ratio, fadeout_ratio)
+
+    if instrument == 'violin':
+        keep_ratio = get_violin_keep_ratio(duration, violin_keep_ratio_by_max_duration)
+        if keep_ratio:
+            samples, duration = reduce_samples_duration(samples, frame_rate, duration, keep_ratio, fadeout_ratio)
+
+    # Amplify
+    amplification_factor = amplification_factors.get(instrument)
+    if amplification_factor:
+        apply_samples_gain(samples, amplification_factor, audio_segment.max_possible_amplitude)
+
+    sound['audio_segment'] = audio_segment._spawn(samples.tobytes())
+    sound['duration_ms'] = duration
+
+    return sound
+
+
+def preprocess_sounds(sounds, silence_thresh, min_silence_duration, keep_ratios, violin_keep_ratio_by_max_duration,
+                      amplification_factors, fadeout_ratio=0.2):
+    """
+    Run preprocess_sound() on every sound
+    The sounds are independent, they are preprocessed in parallel
+    """
+    print("Preprocessing sounds...")
+    preprocess = partial(preprocess_sound,
+                         silence_thresh=silence_thresh,
+                         min_silence_duration=min_silence_duration,
+                         keep_ratios=keep_ratios,
+                         violin_keep_ratio_by_max_duration=violin_keep_ratio_by_max_duration,
+                         amplification_factors=amplification_factors,
+                         fadeout_ratio=fadeout_ratio)
+
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        return list(executor.map(preprocess, sounds))
+
+
 def main(args):
     # Instr     Octaves
     # ------------------
@@ -282,13 +275,7 @@ def main(args):
     CLEAR_elementary_sounds = load_sounds_in_memory(CLEAR_elementary_sounds_infos, args.good_sounds_folder)
 
     # Preprocessing
-    # Remove silence parts
-    CLEAR_elementary_sounds_preprocessed = remove_silence(CLEAR_elementary_sounds,
-                                                          args.silence_threshold,
-                                                          args.min_silence_duration)
-
-    # Reduce the duration of the sounds
-
+    # Remove silence parts, reduce the duration and amplify the sounds
     duration_ratios = {
         'flute': 0.18,
         'trumpet': 0.2,
@@ -298,17 +285,10 @@ def main(args):
         'violin': None      # We use a different function to reduce the size of the violin sounds
     }
 
-    CLEAR_elementary_sounds_preprocessed = reduce_duration_linear_by_instrument(CLEAR_elementary_sounds_preprocessed,
-                                                                                keep_ratios=duration_ratios,
-                                                                                fadeout_ratio=0.1)
-
     violin_duration_ratios = {
         4000: 0.3,
         5000: 0.13
     }
-    CLEAR_elementary_sounds_preprocessed = reduce_duration_linear_violin(CLEAR_elementary_sounds_preprocessed,
-                                                                         keep_ratio_by_max_duration=violin_duration_ratios,
-                                                                         fadeout_ratio=0.1)
 
     amplification_factors = {
         'flute': -8,
@@ -319,7 +299,13 @@ def main(args):
         'bass': -0.5
     }
 
-    CLEAR_elementary_sounds_preprocessed = amplify_by_instrument(CLEAR_elementary_sounds_preprocessed, amplification_factors)
+    CLEAR_elementary_sounds_preprocessed = preprocess_sounds(CLEAR_elementary_sounds,
+                                                             silence_thresh=args.silence_threshold,
+                                                             min_silence_duration=args.min_silence_duration,
+                                                             keep_ratios=duration_ratios,
+                                                             violin_keep_ratio_by_max_duration=violin_duration_ratios,
+                                                             amplification_factors=amplification_factors,
+                                                             fadeout_ratio=0.1)
 
     # Write to file
     write_sounds_to_files(CLEAR_elementary_sounds_preprocessed, args.output_path, args.output_definition_filename)
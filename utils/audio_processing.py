@@ -8,41 +8,290 @@
 #               IGLU - CHIST-ERA
 
 from array import array
-from pydub import AudioSegment
+from functools import lru_cache
+import wave
 import numpy as np
 import pyloudnorm
 from pysndfx import AudioEffectsChain
-from pydub.utils import get_min_max_value, get_frame_width, get_array_type, db_to_float
 from utils.misc import pydub_audiosegment_to_float_array
 
 
-def get_perceptual_loudness(pydub_audio_segment):
-  loudness_meter = pyloudnorm.Meter(pydub_audio_segment.frame_rate, block_size=0.2)
+def load_wav_audiosegment(filepath):
+  """
+  Load a PCM wav file in a pydub AudioSegment
+  The frames are read with the wave module and wrapped as is, without going through AudioSegment.from_wav()
+  """
+  from pydub import AudioSegment
+
+  with wave.open(filepath, 'rb') as wav_file:
+    return AudioSegment(data=wav_file.readframes(wav_file.getnframes()),
+                        sample_width=wav_file.getsampwidth(),
+                        frame_rate=wav_file.getframerate(),
+                        channels=wav_file.getnchannels())
+
 
+def get_perceptual_loudness(pydub_audio_segment):
   sound_float_array = pydub_audiosegment_to_float_array(pydub_audio_segment,
                                                         pydub_audio_segment.frame_rate,
                                                         pydub_audio_segment.sample_width)
 
-  return loudness_meter.integrated_loudness(sound_float_array)
+  return get_samples_perceptual_loudness(sound_float_array, pydub_audio_segment.frame_rate)
+
+
+def get_samples_perceptual_loudness(float_samples, frame_rate):
+  """
+  Same as get_perceptual_loudness() but on samples normalized in [-1, 1] (As returned by soundfile.read)
+  """
+  return get_loudness_meter(frame_rate).integrated_loudness(float_samples)
+
+
+@lru_cache(maxsize=None)
+def get_loudness_meter(frame_rate, block_size=0.2):
+  """
+  Loudness meter for the given frame rate
+  The K-weighting filter coefficients are computed when the meter is created, the meters are reused between calls
+  """
+  return pyloudnorm.Meter(frame_rate, block_size=block_size)
+
+
+def get_longest_non_silent_segment(audio_segment, min_silence_duration, silence_thresh, keep_silence_duration=100):
+  """
+  Return the longest chunk of 'audio_segment' that pydub.silence.split_on_silence() would return (pydub 0.25, seek_step=1)
+  """
+  longest_range = get_longest_non_silent_range(audio_segment, min_silence_duration, silence_thresh, keep_silence_duration)
+
+  if longest_range is None:
+    return audio_segment
+
+  longest_start, longest_end = longest_range
+  return audio_segment[longest_start:longest_end]
+
+
+def get_longest_non_silent_range(audio_segment, min_silence_duration, silence_thresh, keep_silence_duration=100):
+  """
+  Return the (start, end) position (ms) of the longest chunk that pydub.silence.split_on_silence() would return
+  Reproduce pydub 0.25 (With seek_step=1) : The kept silences that overlap between chunks are split at their midpoint
+  (Older versions of pydub keep the whole silence in both chunks)
+  Only the positions are computed, the chunks are never created. None if there is nothing to trim
+  The RMS of every window is computed at once from the cumulative sum of the squared samples
+  instead of slicing the audio segment and computing the RMS for every millisecond
+  """
+  seg_len = len(audio_segment)
+
+  if seg_len < min_silence_duration:
+    # Too short to contain any silence
+    return None
+
+  samples = np.array(audio_segment.get_array_of_samples(), dtype=np.float64).reshape(-1, audio_segment.channels)
+  squared_cumsum = np.concatenate(([0.], np.cumsum(np.square(samples).sum(axis=1))))
+
+  # Frame position of each millisecond (Same rounding as AudioSegment slicing)
+  frame_positions = (np.arange(seg_len + 1) * (audio_segment.frame_rate / 1000.0)).astype(int)
+  frame_positions = np.minimum(frame_positions, len(samples))
+
+  # Mean of the squared samples of every window [i, i + min_silence_duration]
+  window_starts = frame_positions[:seg_len - min_silence_duration + 1]
+  window_ends = frame_positions[min_silence_duration:]
+  nb_window_samples = (window_ends - window_starts) * audio_segment.channels
+  squared_mean = np.zeros(len(window_starts))
+  np.divide(squared_cumsum[window_ends] - squared_cumsum[window_starts], nb_window_samples,
+            out=squared_mean, where=nb_window_samples > 0)
+
+  # pydub compare the integer RMS with the threshold : floor(rms) <= thresh  <=>  rms^2 < (floor(thresh) + 1)^2
+  thresh = 10 ** (silence_thresh / 20) * audio_segment.max_possible_amplitude
+  silence_starts = np.flatnonzero(squared_mean < (np.floor(thresh) + 1) ** 2)
+
+  # Combine the silent windows into silent ranges (Overlapping windows are part of the same range)
+  if len(silence_starts) > 0:
+    range_breaks = np.flatnonzero(np.diff(silence_starts) > min_silence_duration)
+    silent_ranges = zip(silence_starts[np.concatenate(([0], range_breaks + 1))],
+                        silence_starts[np.concatenate((range_breaks, [len(silence_starts) - 1]))] + min_silence_duration)
+  else:
+    silent_ranges = []
+
+  # Non silent ranges are between the silent ranges
+  non_silent_ranges = []
+  previous_end = 0
+  for start, end in silent_ranges:
+    if start > previous_end:
+      non_silent_ranges.append([previous_end - keep_silence_duration, start + keep_silence_duration])
+    previous_end = end
+
+  if previous_end != seg_len:
+    non_silent_ranges.append([previous_end - keep_silence_duration, seg_len + keep_silence_duration])
+
+  if len(non_silent_ranges) == 0:
+    # The whole segment is silent, nothing to trim
+    return None
+
+  # When the kept silences overlap, they are split evenly between the chunks
+  for previous_range, next_range in zip(non_silent_ranges[:-1], non_silent_ranges[1:]):
+    if next_range[0] < previous_range[1]:
+      previous_range[1] = (previous_range[1] + next_range[0]) // 2
+      next_range[0] = previous_range[1]
+
+  chunks = [(max(start, 0), min(end, seg_len)) for start, end in non_silent_ranges]
+  longest_start, longest_end = max(chunks, key=lambda chunk: chunk[1] - chunk[0])
+
+  return int(longest_start), int(longest_end)
+
+
+def get_longest_non_silent_samples(audio_segment, min_silence_duration, silence_thresh, keep_silence_duration=100):
+  """
+  Same frames as get_longest_non_silent_segment() but as a samples array (Shape : (nb_frames, channels))
+  Return the samples (A copy that can be modified in place) and their duration (ms)
+  """
+  samples = np.array(audio_segment.get_array_of_samples()).reshape(-1, audio_segment.channels)
+  longest_range = get_longest_non_silent_range(audio_segment, min_silence_duration, silence_thresh, keep_silence_duration)
+
+  if longest_range is not None:
+    samples = slice_samples(samples, audio_segment.frame_rate, *longest_range)
+
+  return samples, int(len(samples) / audio_segment.frame_rate * 1000)
+
+
+def slice_samples(samples, frame_rate, start, end):
+  """
+  Return the frames of 'samples' (Shape : (nb_frames, channels)) between 'start' and 'end' (ms)
+  Same frames as slicing the AudioSegment : The positions are truncated to the frame and the missing frames at the end
+  are filled with silence. A view of 'samples' is returned when no frame is missing
+  """
+  start_frame = int(start * (frame_rate / 1000.0))
+  end_frame = int(end * (frame_rate / 1000.0))
+  sliced_samples = samples[start_frame:end_frame]
+
+  nb_missing_frames = (end_frame - start_frame) - len(sliced_samples)
+  if nb_missing_frames > 0:
+    silence = np.zeros((nb_missing_frames, samples.shape[1]), dtype=samples.dtype)
+    sliced_samples = np.concatenate((sliced_samples, silence))
 
+  return sliced_samples
 
-def generate_random_noise(duration, gain, frame_width, sample_rate):
-  bit_depth = 8 * frame_width
-  minval, maxval = get_min_max_value(bit_depth)
-  sample_width = get_frame_width(bit_depth)
-  array_type = get_array_type(bit_depth)
 
-  gain = db_to_float(gain)
-  sample_count = int(sample_rate * (duration / 1000.0))
+def linear_fade(audio_segment, fade_duration, fade_in=False):
+  """
+  Linear fade of the last 'fade_duration' ms of the audio segment (Or the first ms if 'fade_in' is set)
+  Same gain ramp as AudioSegment.fade_out()/fade_in() (Down to -120 dB) but computed for every sample at once
+  """
+  samples = np.array(audio_segment.get_array_of_samples()).reshape(-1, audio_segment.channels)
+  apply_linear_fade(samples, int(fade_duration * audio_segment.frame_rate / 1000), fade_in)
 
-  data = ((np.random.rand(sample_count, 1) * 2) - 1.0) * maxval * gain
+  return audio_segment._spawn(samples.tobytes())
 
-  return AudioSegment(data=data.astype(array_type).tobytes(), metadata={
-    "channels": 1,
-    "sample_width": sample_width,
-    "frame_rate": sample_rate,
-    "frame_width": sample_width,
-  })
+
+def apply_linear_fade(samples, nb_fade_frames, fade_in=False):
+  """
+  Apply the linear fade in place on the first/last 'nb_fade_frames' frames of 'samples' (Shape : (nb_frames, channels))
+  """
+  nb_fade_frames = min(nb_fade_frames, len(samples))
+  envelope = get_linear_fade_envelope(nb_fade_frames, fade_in)
+
+  if fade_in:
+    samples[:nb_fade_frames] = samples[:nb_fade_frames] * envelope
+  else:
+    samples[len(samples) - nb_fade_frames:] = samples[len(samples) - nb_fade_frames:] * envelope
+
+
+def reduce_samples_duration(samples, frame_rate, duration, keep_ratio, fadeout_ratio=0.2):
+  """
+  Keep the first 'keep_ratio' of the 'duration' ms of 'samples' and fade out the last 'fadeout_ratio' of the kept part
+  Same frames as linear_fade(audio_segment[:new_duration], int(new_duration * fadeout_ratio))
+  Return the kept samples (The fade is applied in place) and their duration (ms)
+  """
+  new_duration = int(duration * keep_ratio)
+  samples = slice_samples(samples, frame_rate, 0, new_duration)
+  fade_duration = int(new_duration * fadeout_ratio)
+  apply_linear_fade(samples, int(fade_duration * frame_rate / 1000))
+
+  return samples, new_duration
+
+
+@lru_cache(maxsize=64)
+def get_linear_fade_envelope(nb_fade_frames, fade_in=False):
+  """
+  Gain of every frame of a linear fade (Down to -120 dB). Shape : (nb_fade_frames, 1)
+  The envelopes are cached since the same fade is usually applied to many sounds. They are read only
+  """
+  silent_gain = 10 ** (-120 / 20)
+
+  if fade_in:
+    envelope = np.linspace(silent_gain, 1.0, nb_fade_frames, endpoint=False)[:, None]
+  else:
+    envelope = np.linspace(1.0, silent_gain, nb_fade_frames, endpoint=False)[:, None]
+
+  envelope.setflags(write=False)
+
+  return envelope
+
+
+def linear_crossfade(first_segment, second_segment, crossfade_duration):
+  """
+  Append 'second_segment' to 'first_segment' with a linear crossfade of 'crossfade_duration' ms
+  Same result as overlaying linear_fade() of the end of the first segment with linear_fade(fade_in=True) of the start
+  of the second segment, but the fades and the overlay are computed on the samples and a single segment is created
+  """
+  def to_samples(audio_segment):
+    return np.array(audio_segment.get_array_of_samples()).reshape(-1, audio_segment.channels)
+
+  nb_fade_frames = int(crossfade_duration * first_segment.frame_rate / 1000)
+
+  fade_out_segment = first_segment[-crossfade_duration:]
+  fade_out_samples = to_samples(fade_out_segment)
+  fade_in_samples = to_samples(second_segment[:crossfade_duration])
+  apply_linear_fade(fade_out_samples, nb_fade_frames)
+  apply_linear_fade(fade_in_samples, nb_fade_frames, fade_in=True)
+
+  # Like AudioSegment.__mul__(), the fade out is cut (Or padded with silence) to its length rounded to the millisecond
+  # and the fade in is looped over it. The samples are summed and clipped like audioop.add
+  nb_crossfade_frames = int(fade_out_segment.frame_count(ms=len(fade_out_segment)))
+  crossfade_samples = np.zeros((nb_crossfade_frames, first_segment.channels), dtype=np.int64)
+  nb_fade_out_frames = min(nb_crossfade_frames, len(fade_out_samples))
+  crossfade_samples[:nb_fade_out_frames] = fade_out_samples[:nb_fade_out_frames]
+  crossfade_samples += np.resize(fade_in_samples, crossfade_samples.shape)
+
+  max_amplitude = int(first_segment.max_possible_amplitude)
+  np.clip(crossfade_samples, -max_amplitude, max_amplitude - 1, out=crossfade_samples)
+
+  samples = np.concatenate((to_samples(first_segment[:-crossfade_duration]),
+                            crossfade_samples.astype(fade_out_samples.dtype),
+                            to_samples(second_segment[crossfade_duration:])))
+
+  return first_segment._spawn(samples.tobytes())
+
+
+def apply_gain(audio_segment, gain):
+  """
+  Same as AudioSegment.apply_gain() (Clipped and rounded down like audioop.mul) but computed on the samples array
+  'gain' is in dB
+  """
+  samples = np.array(audio_segment.get_array_of_samples())
+  apply_samples_gain(samples, gain, audio_segment.max_possible_amplitude)
+
+  return audio_segment._spawn(samples.tobytes())
+
+
+def apply_samples_gain(samples, gain, max_possible_amplitude):
+  """
+  Apply the gain (dB) in place on integer samples (Clipped and rounded down like audioop.mul)
+  """
+  amplified = samples * (10 ** (gain / 20))
+  np.clip(amplified, -max_possible_amplitude, max_possible_amplitude - 1, out=amplified)
+  np.floor(amplified, out=amplified)
+
+  samples[...] = amplified
+
+
+def generate_random_noise(nb_samples, gain, rng):
+  """
+  Uniform white noise normalized in [-1, 1] with the gain (dB) applied
+  'rng' is a numpy random Generator
+  """
+  amplitude = np.float32(10 ** (gain / 20))
+  noise = rng.random(nb_samples, dtype=np.float32)
+  noise *= 2 * amplitude
+  noise -= amplitude
+
+  return noise
 
 
 def add_reverberation(sound,
@@ -65,3 +314,23 @@ def add_reverberation(sound,
   )
 
   return transformer(sound)
+
+
+def frame_and_window(samples, window, hop, out=None):
+  """
+  Split the signal in overlapping frames of len(window) samples and apply the window on each frame.
+  The frames are read through a strided view of the samples and the windowed frames are written directly in 'out'
+  (Shape : (nb_frames, len(window))) so no intermediate frame matrix is created.
+  """
+  window_length = len(window)
+  nb_frames = (len(samples) - window_length) // hop + 1
+
+  frames = np.lib.stride_tricks.as_strided(samples,
+                                           shape=(nb_frames, window_length),
+                                           strides=(hop * samples.strides[0], samples.strides[0]),
+                                           writeable=False)
+
+  if out is None:
+    out = np.empty((nb_frames, window_length), dtype=window.dtype)
+
+  return np.multiply(frames, window, out=out)
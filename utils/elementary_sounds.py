@@ -7,15 +7,36 @@
 #               KTH Stockholm Royal Institute of Technology
 #               IGLU - CHIST-ERA
 
-import json
+import orjson
 import os
 import numpy as np
-from pydub import AudioSegment
-from collections import defaultdict
-from copy import deepcopy
+import soundfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
-from timbral_models import timbral_brightness
-from utils.audio_processing import get_perceptual_loudness
+# Version of the analysis cache. Must be incremented when the analysis changes so the cached values are discarded
+ANALYSIS_VERSION = 3
+
+
+def analyse_elementary_sound(elementary_sound_filename):
+    """
+    Return the duration (ms), the perceptual loudness and the perceptual brightness of a sound file
+    Defined at module level so it can be run in worker processes
+    """
+    # The analysis dependencies (scipy, pyloudnorm, timbral_models) are slow to import.
+    # They are only imported when some sounds are not in the analysis cache
+    from timbral_models import timbral_brightness
+    from utils.audio_processing import get_samples_perceptual_loudness
+
+    # Samples normalized in [-1, 1], read directly by libsndfile
+    elementary_sound_samples, frame_rate = soundfile.read(elementary_sound_filename, dtype='float64')
+
+    duration = int(len(elementary_sound_samples) / frame_rate * 1000)
+    perceptual_loudness = float(get_samples_perceptual_loudness(elementary_sound_samples, frame_rate))
+    # The samples are passed directly so timbral_models doesn't read and decode the file a second time
+    perceptual_brightness = float(timbral_brightness(elementary_sound_samples, fs=frame_rate))
+
+    return duration, perceptual_loudness, perceptual_brightness
 
 
 class Elementary_Sounds:
@@ -27,12 +48,13 @@ class Elementary_Sounds:
       - Give an interface to retrieve sounds
     """
 
-    def __init__(self, folder_path, definition_filename, save_raw_values=False):
+    def __init__(self, folder_path, definition_filename, save_raw_values=False, analysis_cache_filepath=None):
         print("Loading Elementary sounds")
         self.folderpath = folder_path
+        self.analysis_cache_filepath = analysis_cache_filepath
 
-        with open(os.path.join(self.folderpath, definition_filename)) as file:
-            self.definition = json.load(file)
+        with open(os.path.join(self.folderpath, definition_filename), 'rb') as file:
+            self.definition = orjson.loads(file.read())
 
         self.notes = ['C', 'Db', 'D', 'Eb', 'E', 'F', 'F#', 'G', 'Ab', 'A', 'Bb', 'B']
 
@@ -42,28 +64,30 @@ class Elementary_Sounds:
 
         self._preprocess_sounds(save_raw_values, shuffle_sounds=False)
 
-        self.families_count = {}
+        self.families_count = Counter(sound['instrument'] for sound in self.definition)
 
-        self.id_list = [sound['id'] for sound in self.definition]
+        # The ids are the positions in the definition
+        self.id_list = list(range(self.nb_sounds))
 
+        # Shuffled in place by the scene generator. Kept as a list since the sounds are swapped one by one
         self.id_list_shuffled = self.id_list.copy()
 
-        for sound in self.definition:
-            if sound['instrument'] not in self.families_count:
-                self.families_count[sound['instrument']] = 1
-            else:
-                self.families_count[sound['instrument']] += 1
-
         self.families = self.families_count.keys()
         self.nb_families = len(self.families)
 
+        # Index of the instrument family of each sound (Indexed by sound id)
+        self.family_indexes = {family: i for i, family in enumerate(self.families)}
+        self.family_index_by_id = np.array([self.family_indexes[sound['instrument']] for sound in self.definition],
+                                          dtype=np.int32)
+
         self.generated_count_by_index = {i: 0 for i in range(self.nb_sounds)}
         self.generated_count_by_families = {fam: 0 for fam in self.families}
         self.gen_index = 0
 
     def get(self, index):
         # Return copy of element to prevent augmented attribute overwriting
-        return deepcopy(self.definition[index])
+        # The attributes are all scalar values so a shallow copy is enough
+        return self.definition[index].copy()
 
     def __getitem__(self, item):
         return self.get(item)
@@ -81,46 +105,31 @@ class Elementary_Sounds:
         """
 
         if shuffle_sounds:
-            np.random.shuffle(self.definition)
-
-        max_brightness = -9999
-        min_brightness = 9999
-        max_loudness = -9999
-        min_loudness = 9999
+            # Only the indexes are shuffled, the definitions are then picked in the shuffled order
+            self.definition = [self.definition[i] for i in np.random.permutation(self.nb_sounds)]
 
-        for id, elementary_sound in enumerate(self.definition):
-            elementary_sound_filename = os.path.join(self.folderpath, elementary_sound['filename'])
-            elementary_sound_audiosegment = AudioSegment.from_wav(elementary_sound_filename)
+        analysis = self._analyse_sounds()
 
+        for id, (elementary_sound, (duration, loudness, brightness)) in enumerate(zip(self.definition, analysis)):
             elementary_sound['id'] = id
 
-            elementary_sound['duration'] = int(elementary_sound_audiosegment.duration_seconds * 1000)
+            elementary_sound['duration'] = duration
 
-            perceptual_loudness = get_perceptual_loudness(elementary_sound_audiosegment)
-            elementary_sound['raw_loudness'] = perceptual_loudness
+            elementary_sound['raw_loudness'] = loudness
 
             self.sorted_durations.append(elementary_sound['duration'])
 
-            elementary_sound['raw_brightness'] = timbral_brightness(elementary_sound_filename)
+            elementary_sound['raw_brightness'] = brightness
 
-            if min_brightness > elementary_sound['raw_brightness']:
-                min_brightness = elementary_sound['raw_brightness']
-
-            if max_brightness < elementary_sound['raw_brightness']:
-                max_brightness = elementary_sound['raw_brightness']
-
-            if min_loudness > elementary_sound['raw_loudness']:
-                min_loudness = elementary_sound['raw_loudness']
-
-            if max_loudness < elementary_sound['raw_loudness']:
-                max_loudness = elementary_sound['raw_loudness']
-
-        # Normalize the brightness per instrument and assign the brightness label
-        for id, elementary_sound in enumerate(self.definition):
-            # Normalize attributes
-            normalized_brightness = (elementary_sound['raw_brightness'] - min_brightness) / (max_brightness - min_brightness)
-            normalized_loudness = (elementary_sound['raw_loudness'] - min_loudness) / (max_loudness - min_loudness)
+        # Normalize the brightness and loudness of all the sounds at once (Min-max scaling over the whole set)
+        _, raw_loudness, raw_brightness = np.array(analysis, dtype=np.float64).reshape(-1, 3).T
+        normalized_brightnesses = (raw_brightness - raw_brightness.min()) / (raw_brightness.max() - raw_brightness.min())
+        normalized_loudnesses = (raw_loudness - raw_loudness.min()) / (raw_loudness.max() - raw_loudness.min())
 
+        # Assign the brightness and loudness labels
+        for elementary_sound, normalized_brightness, normalized_loudness in zip(self.definition,
+                                                                                normalized_brightnesses.tolist(),
+                                                                                normalized_loudnesses.tolist()):
             # Assign brightness label
             if normalized_brightness > 0.47:
                 elementary_sound['brightness'] = 'bright'
@@ -145,24 +154,64 @@ class Elementary_Sounds:
         self.sorted_durations = sorted(self.sorted_durations)
         self.half_longest_durations_mean = np.mean(self.sorted_durations[-int(self.nb_sounds/2):])
 
-    def sounds_to_families_count(self, sound_list):
+    def _analyse_sounds(self):
         """
-        Return the frequence of each instrument family
+        Analyse every elementary sound (Duration, loudness and brightness)
+          - The results are cached in 'analysis_cache_filepath' (JSON) when it is set
+          - Only the sounds that are new or were modified since the last run are analysed
         """
-        count = {}
+        filepaths = [os.path.abspath(os.path.join(self.folderpath, elementary_sound['filename']))
+                     for elementary_sound in self.definition]
 
-        for sound in sound_list:
-            family = sound['instrument']
-            if family in count:
-                count[family] += 1
-            else:
-                count[family] = 1
+        cache = self._load_analysis_cache()
 
-        non_empty_families = count.keys()
-        non_empty_families_count = len(non_empty_families)
+        signatures = {}
+        for filepath in filepaths:
+            file_stat = os.stat(filepath)
+            signatures[filepath] = [file_stat.st_mtime_ns, file_stat.st_size]
 
-        empty_families = set(self.families) - set(non_empty_families)
-        for family in empty_families:
-            count[family] = 0
+        to_analyse = [filepath for filepath, signature in signatures.items()
+                      if filepath not in cache or cache[filepath]['signature'] != signature]
 
-        return count, non_empty_families_count
+        if len(to_analyse) > 0:
+            # The sounds are analysed independently, the analysis is distributed across all the cores
+            with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+                for filepath, sound_analysis in zip(to_analyse, executor.map(analyse_elementary_sound, to_analyse)):
+                    cache[filepath] = {
+                        'signature': signatures[filepath],
+                        'analysis': list(sound_analysis)
+                    }
+
+            self._save_analysis_cache(cache)
+
+        return [cache[filepath]['analysis'] for filepath in filepaths]
+
+    def _load_analysis_cache(self):
+        """
+        Return the cached analysis of the sounds (Indexed by absolute filepath)
+        An empty cache is returned if there is no cache file or if it can't be used
+        """
+        if self.analysis_cache_filepath is None or not os.path.isfile(self.analysis_cache_filepath):
+            return {}
+
+        try:
+            with open(self.analysis_cache_filepath, 'rb') as f:
+                cache = orjson.loads(f.read())
+        except (OSError, orjson.JSONDecodeError):
+            print("[WARNING] Could not read the elementary sounds analysis cache '%s'" % self.analysis_cache_filepath)
+            return {}
+
+        if not isinstance(cache, dict) or cache.get('version') != ANALYSIS_VERSION:
+            return {}
+
+        return cache['sounds']
+
+    def _save_analysis_cache(self, cache):
+        if self.analysis_cache_filepath is None:
+            return
+
+        try:
+            with open(self.analysis_cache_filepath, 'wb') as f:
+                f.write(orjson.dumps({'version': ANALYSIS_VERSION, 'sounds': cache}))
+        except OSError:
+            print("[WARNING] Could not write the elementary sounds analysis cache '%s'" % self.analysis_cache_filepath)
@@ -8,10 +8,10 @@
 #               IGLU - CHIST-ERA
 
 import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+from multiprocessing.shared_memory import SharedMemory
 from array import array
-from pydub import AudioSegment
-from pydub.utils import get_array_type
 import random
 import time
 import json
@@ -36,6 +36,18 @@ def save_arguments(args, folder_path, filename):
         json.dump(vars(args), f, indent=2)
 
 
+# Number of threads used to load or write files concurrently
+NB_IO_WORKERS = 16
+
+
+def map_concurrently(function, *iterables):
+    """
+    Same as list(map(function, *iterables)) but the calls are run concurrently in threads
+    Suited for calls that are mostly waiting on disk, like loading or writing audio files
+    """
+    with ThreadPoolExecutor(max_workers=NB_IO_WORKERS) as executor:
+        return list(executor.map(function, *iterables))
+
 '''
 Format conversion
 '''
@@ -83,12 +95,42 @@ def float_array_to_pydub_audiosegment(float_array, frame_rate, n_bytes):
 
     scaled = np.multiply(scale, float_array).astype(to_pydub_bit_depth_to_np_type[bit_depth])
 
+    # pydub is only imported when needed, it probes for ffmpeg at import
+    from pydub import AudioSegment
+
     return AudioSegment(scaled.tobytes(),
                         frame_rate=frame_rate,
                         sample_width=n_bytes,
                         channels=1)
 
 
+'''
+Shared memory
+'''
+def ndarray_to_shared_memory(array):
+    """
+    Copy a numpy array in a new shared memory block.
+    Return the shared memory block, the array backed by the block and the descriptor used to attach to it.
+    """
+    shared_memory = SharedMemory(create=True, size=max(array.nbytes, 1))
+
+    shared_array = np.ndarray(array.shape, dtype=array.dtype, buffer=shared_memory.buf)
+    shared_array[:] = array
+
+    return shared_memory, shared_array, (shared_memory.name, array.shape, array.dtype.str)
+
+
+def ndarray_from_shared_memory(descriptor):
+    """
+    Attach to a shared memory block created by ndarray_to_shared_memory().
+    The returned shared memory block must be kept alive as long as the array is used
+    """
+    name, shape, dtype = descriptor
+    shared_memory = SharedMemory(name=name)
+
+    return shared_memory, np.ndarray(shape, dtype=dtype, buffer=shared_memory.buf)
+
+
 def get_max_scene_length(scenes):
   return np.max([len(scene['objects']) for scene in scenes])
 